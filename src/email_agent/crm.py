@@ -1,18 +1,71 @@
+import functools
+import os
+import threading
 import mysql.connector
+from mysql.connector import pooling
+
+DB_CONFIG = {
+    "host": "localhost",
+    "user": "root",
+    "password": "",
+    "database": "E-commerce_query",
+}
+POOL_SIZE = 8
+
+# Connection pool shared by every query helper, created on first use
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Per-thread prepared cursors, keyed by (server connection id, statement)
+_cursor_cache = threading.local()
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool, _pool_pid
+    # A pool inherited across fork() shares sockets with the parent, so rebuild it
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name="crm",
+                    pool_size=POOL_SIZE,
+                    pool_reset_session=False,
+                    **DB_CONFIG
+                )
+                _pool_pid = os.getpid()
+    return _pool
 
 def get_db_connection():
+    """Check out a pooled connection; close() on it returns it to the pool."""
     try:
-        conn = mysql.connector.connect(
-            host="localhost",
-            user="root",
-            password="",
-            database="E-commerce_query"
-        )
-        return conn
+        return get_pool().get_connection()
     except mysql.connector.Error as err:
         print(f"Error: {err}")
         return None
 
+def _prepared_cursor(conn, query):
+    """Return a cached prepared cursor for this connection and statement."""
+    cursors = getattr(_cursor_cache, "cursors", None)
+    if cursors is None:
+        cursors = _cursor_cache.cursors = {}
+
+    key = (conn.connection_id, query)
+    cursor = cursors.get(key)
+    if cursor is None:
+        cursor = conn.cursor(prepared=True)
+        cursors[key] = cursor
+    return key, cursor
+
+def _discard_prepared_cursor(key):
+    """Drop a cached cursor whose connection may no longer be usable."""
+    cursor = getattr(_cursor_cache, "cursors", {}).pop(key, None)
+    if cursor is not None:
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            pass
+
 def create_tables():
     conn = get_db_connection()
     if conn is None:
@@ -44,6 +97,50 @@ def create_tables():
     conn.close()
 
 
+UPSERT_CUSTOMER_QUERY = """
+    INSERT INTO customers_query (email, customer_name, address, user_message, agent_mail, refund_requested, status, product_issue, order_id)
+    VALUES (%s, %s, %s, %s, %s, %s, 'in_progress', %s, %s)
+    ON DUPLICATE KEY UPDATE 
+        customer_name = COALESCE(%s, customer_name),
+        address = COALESCE(%s, address),
+        user_message = COALESCE(%s, user_message),
+        agent_mail = COALESCE(%s, agent_mail),
+        refund_requested = COALESCE(%s, refund_requested),
+        product_issue = COALESCE(%s, product_issue),
+        order_id = COALESCE(%s, order_id),
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+
+# executemany rewrites an INSERT into one multi-row VALUES statement and only binds the VALUES
+# placeholders, so the update clause reads the inserted row through VALUES(col) instead of %s
+UPSERT_CUSTOMER_QUERY_BATCH = """
+    INSERT INTO customers_query (email, customer_name, address, user_message, agent_mail, refund_requested, status, product_issue, order_id)
+    VALUES (%s, %s, %s, %s, %s, %s, 'in_progress', %s, %s)
+    ON DUPLICATE KEY UPDATE 
+        customer_name = COALESCE(VALUES(customer_name), customer_name),
+        address = COALESCE(VALUES(address), address),
+        user_message = COALESCE(VALUES(user_message), user_message),
+        agent_mail = COALESCE(VALUES(agent_mail), agent_mail),
+        refund_requested = COALESCE(VALUES(refund_requested), refund_requested),
+        product_issue = COALESCE(VALUES(product_issue), product_issue),
+        order_id = COALESCE(VALUES(order_id), order_id),
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+
+def _customer_query_row(email, customer_name=None, address=None, user_message=None, agent_mail=None, refund_requested=None, product_issue=None, order_id=None):
+    """Build the VALUES bind values shared by both upsert statements."""
+    return (email, customer_name, address, user_message, agent_mail, refund_requested, product_issue, order_id)
+
+
+def _customer_query_values(*args, **kwargs):
+    """Build the bind values for UPSERT_CUSTOMER_QUERY."""
+    row = _customer_query_row(*args, **kwargs)
+    # The update clause repeats every column except email
+    return row + row[1:]
+
+
 def insert_partial_customer_query(email, customer_name=None, address=None, user_message=None, agent_mail=None, refund_requested=None, product_issue=None, order_id=None):
     """Insert or update customer query data."""
     conn = get_db_connection()
@@ -51,57 +148,108 @@ def insert_partial_customer_query(email, customer_name=None, address=None, user_
         print("❌ Failed to connect to database.")
         return {"status": "error", "message": "Database connection failed."}
 
+    key = None
     try:
-        cursor = conn.cursor()
+        # The statement is prepared once per connection and reused on later calls
+        key, cursor = _prepared_cursor(conn, UPSERT_CUSTOMER_QUERY)
 
-        query = """
-            INSERT INTO customers_query (email, customer_name, address, user_message, agent_mail, refund_requested, status, product_issue, order_id)
-            VALUES (%s, %s, %s, %s, %s, %s, 'in_progress', %s, %s)
-            ON DUPLICATE KEY UPDATE 
-                customer_name = COALESCE(%s, customer_name),
-                address = COALESCE(%s, address),
-                user_message = COALESCE(%s, user_message),
-                agent_mail = COALESCE(%s, agent_mail),
-                refund_requested = COALESCE(%s, refund_requested),
-                product_issue = COALESCE(%s, product_issue),
-                order_id = COALESCE(%s, order_id),
-                updated_at = CURRENT_TIMESTAMP
-        """
-
-        values = (
-            email, customer_name, address, user_message, agent_mail, refund_requested, product_issue, order_id,
-            customer_name, address, user_message, agent_mail, refund_requested, product_issue, order_id
+        values = _customer_query_values(
+            email, customer_name, address, user_message, agent_mail, refund_requested, product_issue, order_id
         )
 
-        cursor.execute(query, values)
+        cursor.execute(UPSERT_CUSTOMER_QUERY, values)
         conn.commit()
 
         print(f"✅ Data inserted/updated for email: {email}")
         return {"status": "success", "message": "Data inserted/updated successfully."}
     except mysql.connector.Error as err:
+        if key is not None:
+            _discard_prepared_cursor(key)
         print(f"❌ Error: {err}")
         return {"status": "error", "message": str(err)}
     finally:
-        cursor.close()
         conn.close()
 
 
-def update_customer_query(email, **kwargs):
-    """Update customer query fields dynamically."""
+def insert_partial_customer_query_batch(rows):
+    """
+    Insert or update many customer queries in a single transaction.
+
+    Args:
+        rows (list[tuple]): Positional arguments for insert_partial_customer_query,
+            e.g. (email,) or (email, customer_name, address, ...)
+
+    Returns:
+        dict: Status of the batch operation
+    """
+    if not rows:
+        return {"status": "success", "message": "No rows to insert."}
+
     conn = get_db_connection()
     if conn is None:
         print("❌ Failed to connect to database.")
         return {"status": "error", "message": "Database connection failed."}
 
+    cursor = None
     try:
         cursor = conn.cursor()
 
-        # Dynamically create SET clause
-        set_clause = ", ".join(f"{key} = %s" for key in kwargs)
-        query = f"UPDATE customers_query SET {set_clause}, updated_at = CURRENT_TIMESTAMP WHERE email = %s"
+        values = [_customer_query_row(*row) for row in rows]
+
+        conn.start_transaction()
+        cursor.executemany(UPSERT_CUSTOMER_QUERY_BATCH, values)
+        conn.commit()
+
+        print(f"✅ Data inserted/updated for {len(values)} emails")
+        return {"status": "success", "message": f"Inserted/updated {len(values)} rows."}
+    except mysql.connector.Error as err:
+        conn.rollback()
+        print(f"❌ Error: {err}")
+        return {"status": "error", "message": str(err)}
+    finally:
+        if cursor is not None:
+            cursor.close()
+        conn.close()
+
+
+# Columns update_customer_query may set; anything else is rejected before building SQL
+UPDATABLE_COLUMNS = frozenset({
+    "customer_name", "address", "user_message", "agent_mail",
+    "refund_requested", "status", "product_issue", "order_id",
+})
+
+
+@functools.lru_cache(maxsize=64)
+def _update_statement(columns):
+    """Build the UPDATE statement and its column order for a set of column names."""
+    column_order = tuple(sorted(columns))
+    set_clause = ", ".join(f"{column} = %s" for column in column_order)
+    query = f"UPDATE customers_query SET {set_clause}, updated_at = CURRENT_TIMESTAMP WHERE email = %s"
+    return query, column_order
+
+
+def update_customer_query(email, **kwargs):
+    """Update customer query fields dynamically."""
+    unknown = set(kwargs) - UPDATABLE_COLUMNS
+    if unknown:
+        print(f"❌ Unknown fields: {', '.join(sorted(unknown))}")
+        return {"status": "error", "message": f"Unknown fields: {', '.join(sorted(unknown))}."}
+    if not kwargs:
+        return {"status": "error", "message": "No fields to update."}
+
+    conn = get_db_connection()
+    if conn is None:
+        print("❌ Failed to connect to database.")
+        return {"status": "error", "message": "Database connection failed."}
+
+    key = None
+    try:
+        # One statement per distinct set of columns, prepared once per connection
+        query, column_order = _update_statement(frozenset(kwargs))
+        key, cursor = _prepared_cursor(conn, query)
 
         # Add email as the last value
-        values = tuple(kwargs.values()) + (email,)
+        values = tuple(kwargs[column] for column in column_order) + (email,)
 
         cursor.execute(query, values)
         conn.commit()
@@ -113,10 +261,11 @@ def update_customer_query(email, **kwargs):
             print("⚠️ No record found with the given email.")
             return {"status": "error", "message": "Email not found."}
     except mysql.connector.Error as err:
+        if key is not None:
+            _discard_prepared_cursor(key)
         print(f"❌ Error: {err}")
         return {"status": "error", "message": str(err)}
     finally:
-        cursor.close()
         conn.close()
 
 
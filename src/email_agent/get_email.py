@@ -1,20 +1,29 @@
 import imaplib
-import email
+import select
+import ssl
+from email import policy
+from email.parser import BytesParser
 from email.header import decode_header
 import os
+import sys
 import asyncio
 import csv
+import glob
+import itertools
 import datetime
 import shutil
+import threading
 import re
-from pydub import AudioSegment
-import speech_recognition as sr
+import time
+import ctranslate2
+from faster_whisper import WhisperModel, BatchedInferencePipeline, decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from loguru import logger
 from dotenv import load_dotenv
-from email_agent.send_mail import process_customer_complaint, clean_email_body, process_email_sending
-from email_agent.crm import insert_partial_customer_query
+from email_agent.send_mail import BatchingProcessor, process_email_sending_async, process_email_sending_bulk, prewarm_smtp_pool
+from email_agent.crm import insert_partial_customer_query_batch
 
 load_dotenv()
 
@@ -24,8 +33,20 @@ PASSWORD = os.getenv('MAIL_PASSWORD')
 IMAP_SERVER = os.getenv('IMAP')
 IMAP_PORT = 993
 
-# Track the latest email ID we've processed
-last_processed_id = 0
+# Track the latest email UID we've processed (None until the first run)
+last_processed_uid = None
+
+# Backoff between IMAP reconnect attempts, in seconds
+IMAP_RETRY_DELAY = 5
+IMAP_MAX_RETRY_DELAY = 300
+
+# How long to stay in IMAP IDLE before re-issuing it; servers drop idle
+# sessions after roughly 10 minutes
+IDLE_TIMEOUT = 540
+# IDLE checks for a stop request this often, so shutdown never waits on a long select()
+IDLE_POLL_INTERVAL = 1
+# Tags for our own IDLE commands; imaplib's tag counter is left alone
+_idle_tags = itertools.count(1)
 
 # Define the directory to save downloaded files
 DOWNLOAD_DIR = "email_attachments"
@@ -33,21 +54,74 @@ if not os.path.exists(DOWNLOAD_DIR):
     os.makedirs(DOWNLOAD_DIR)
     logger.info(f"Created download directory: {DOWNLOAD_DIR}")
 
+# Cleanup tasks running in the background; referenced here so they aren't garbage collected
+_background_tasks = set()
+
 # CSV file to track downloads
 CSV_FILE = "email_downloads.csv"
 CSV_HEADERS = ["timestamp", "sender", "subject", "filename", "file_path"]
 
+# Download rows waiting to be written to the CSV file
+_csv_buf = []
+
 # List of supported audio/video file extensions
-SUPPORTED_EXTENSIONS = [
+SUPPORTED_EXTENSIONS = frozenset({
     # Video formats
     '.mp4', '.mov', '.avi', '.mkv', '.wmv', '.flv', '.webm', '.m4v', '.3gp',
     # Audio formats
     '.mp3', '.wav', '.aac', '.ogg', '.flac', '.m4a', '.wma'
-]
+})
+
+# Extensions of downloaded files that are picked up for transcription
+_AUDIO_EXT = ('.wav', '.mp3', '.flac', '.ogg')
+
+# Patterns used for every incoming email, compiled once
+_NAME_ANGLE = re.compile(r'^(.*?)\s<')
+_NAME_QUOTE = re.compile(r'"(.*?)"')
+_EMAIL_ANGLE = re.compile(r'<(.*?)>')
+_FN_SANITIZE = re.compile(r'[\\/*?:"<>|]')
+_UIDNEXT = re.compile(rb'UIDNEXT (\d+)')
+
+# Parser producing EmailMessage objects with decoded headers and content helpers
+email_parser = BytesParser(policy=policy.default)
+
+# Flush pending CRM rows once this many have accumulated in a poll cycle
+CRM_BATCH_SIZE = 500
 
 # Flag to track if we're currently processing files
 is_processing = False
 
+# Local Whisper model used for speech recognition, loaded once and shared by all files
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "small")
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_BATCH_SIZE = 16
+WHISPER_DEVICE = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+# int8 weights halve the memory traffic of the decoder; keep float16 activations on GPU
+WHISPER_COMPUTE_TYPE = os.getenv(
+    "WHISPER_COMPUTE_TYPE", "int8_float16" if WHISPER_DEVICE == "cuda" else "int8"
+)
+asr_model = WhisperModel(WHISPER_MODEL, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE_TYPE)
+asr_pipeline = BatchedInferencePipeline(model=asr_model)
+
+# Minimum amount of detected speech for a recording to be transcribed
+MIN_SPEECH_SECONDS = 5
+
+# Whisper decodes audio in windows of this many seconds
+WHISPER_CHUNK_SECONDS = 30
+# Context kept either side of each speech region when it is handed to Whisper
+SPEECH_CLIP_PAD_SECONDS = 0.2
+# Unpadded regions split at short pauses, so the measured seconds are actual speech;
+# capped so a padded region still fits one Whisper window
+SPEECH_VAD_OPTIONS = VadOptions(
+    speech_pad_ms=0,
+    min_silence_duration_ms=160,
+    max_speech_duration_s=WHISPER_CHUNK_SECONDS - 2 * SPEECH_CLIP_PAD_SECONDS,
+)
+
+# Cap on concurrent transcriptions running on the model
+RECOGNITION_CONCURRENCY = 2
+recognition_semaphore = asyncio.Semaphore(RECOGNITION_CONCURRENCY)
+
 # Standard response messages
 SHORT_TEXT_RESPONSE = {
     "subject": "Additional Information Required",
@@ -71,61 +145,90 @@ async def clear_directory():
     """Completely empties the download directory."""
     try:
         logger.info(f"Clearing directory: {DOWNLOAD_DIR}")
-        for filename in os.listdir(DOWNLOAD_DIR):
-            file_path = os.path.join(DOWNLOAD_DIR, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-                logger.info(f"Deleted file during cleanup: {file_path}")
-            except Exception as e:
-                logger.error(f"Error deleting {file_path}: {e}")
+        # Swap in a fresh directory in one rename; the old contents are deleted in the background
+        trash_dir = f"{DOWNLOAD_DIR}.trash.{time.time_ns()}"
+        os.rename(DOWNLOAD_DIR, trash_dir)
+        os.makedirs(DOWNLOAD_DIR)
+        task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, trash_dir, ignore_errors=True))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        logger.info(f"Moved old downloads to {trash_dir} for deletion")
+    except FileNotFoundError:
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
     except Exception as e:
         logger.error(f"Error clearing directory: {e}")
 
+async def sweep_trash_directories():
+    """Delete trash directories left behind when a previous run exited mid-cleanup."""
+    leftovers = [path for path in glob.glob(f"{glob.escape(DOWNLOAD_DIR)}.trash.*") if os.path.isdir(path)]
+    if not leftovers:
+        return
+    logger.info(f"Removing {len(leftovers)} leftover trash directories")
+    for path in leftovers:
+        await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+
 def log_download_to_csv(sender, subject, filename, file_path):
-    """Log download information to CSV file"""
+    """Queue download information for the CSV file; written by flush_csv()"""
+    _csv_buf.append({
+        "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "sender": sender,
+        "subject": subject,
+        "filename": filename,
+        "file_path": file_path
+    })
+    logger.info(f"Logged download info to CSV: {filename}")
+
+def flush_csv():
+    """Append all queued download rows to the CSV file in a single write"""
+    if not _csv_buf:
+        return
     with open(CSV_FILE, 'a', newline='', encoding='utf-8') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=CSV_HEADERS)
-        writer.writerow({
-            "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "sender": sender,
-            "subject": subject,
-            "filename": filename,
-            "file_path": file_path
-        })
-    logger.info(f"Logged download info to CSV: {filename}")
+        writer.writerows(_csv_buf)
+    logger.info(f"Wrote {len(_csv_buf)} download rows to CSV: {CSV_FILE}")
+    _csv_buf.clear()
 
-async def convert_mp3_to_wav(file_path):
-    """Converts MP3 to WAV and returns the new file path."""
-    wav_path = file_path.replace(".mp3", ".wav")  # Change extension
-    try:
-        audio = AudioSegment.from_mp3(file_path)
-        audio.export(wav_path, format="wav")  # Convert to WAV
-        logger.info(f"Converted {file_path} to {wav_path}")
-        # Delete the original MP3 file after conversion
-        os.remove(file_path)
-        logger.info(f"Deleted original MP3 file: {file_path}")
-        return wav_path
-    except Exception as e:
-        logger.error(f"Failed to convert {file_path} to WAV: {e}")
-        return None
+def write_file(file_path, data):
+    """Write bytes to a file, replacing any existing content."""
+    with open(file_path, 'wb', buffering=1 << 20) as f:
+        f.write(data)
+
+def detect_speech(samples):
+    """Return the Silero VAD speech regions of 16 kHz mono float32 samples, in sample offsets."""
+    return get_speech_timestamps(samples, vad_options=SPEECH_VAD_OPTIONS, sampling_rate=WHISPER_SAMPLE_RATE)
+
+def speech_clips(speech_timestamps, num_samples):
+    """Pad speech regions and group them into clips of at most one Whisper window, in seconds."""
+    pad = int(SPEECH_CLIP_PAD_SECONDS * WHISPER_SAMPLE_RATE)
+    window = WHISPER_CHUNK_SECONDS * WHISPER_SAMPLE_RATE
+    clips = []
+    for ts in speech_timestamps:
+        start = max(ts["start"] - pad, 0)
+        end = min(ts["end"] + pad, num_samples)
+        if clips and end - clips[-1][0] <= window:
+            clips[-1][1] = end
+        else:
+            clips.append([max(start, clips[-1][1]) if clips else start, end])
+    return [{"start": start / WHISPER_SAMPLE_RATE, "end": end / WHISPER_SAMPLE_RATE} for start, end in clips]
+
+def transcribe(samples, speech_timestamps):
+    """Transcribe the detected speech with the batched Whisper pipeline."""
+    # The regions are already known, so the pipeline must not run VAD a second time
+    segments, _ = asr_pipeline.transcribe(
+        samples,
+        vad_filter=False,
+        clip_timestamps=speech_clips(speech_timestamps, len(samples)),
+        batch_size=WHISPER_BATCH_SIZE,
+    )
+    return " ".join(segment.text.strip() for segment in segments).strip()
 
 async def process_audio(file_path):
     """Processes the audio file and converts speech to text. Returns None if audio is too short."""
-    recognizer = sr.Recognizer()
-    
-    # Convert MP3 to WAV if necessary
-    if file_path.endswith(".mp3"):
-        file_path = await convert_mp3_to_wav(file_path)
-        if file_path is None:
-            return None  # Skip if conversion failed
-
     try:
-        # First check the duration of the audio file
-        audio = AudioSegment.from_file(file_path)
-        duration_seconds = len(audio) / 1000  # Convert from ms to seconds
+        # Decode and resample to the 16 kHz mono float32 input Whisper expects in a worker;
+        # the same samples are used for the duration check and recognition
+        samples = await asyncio.to_thread(decode_audio, file_path, sampling_rate=WHISPER_SAMPLE_RATE)
+        duration_seconds = len(samples) / WHISPER_SAMPLE_RATE
         
         # Check if audio is too short
         if duration_seconds < 5:
@@ -135,12 +238,27 @@ async def process_audio(file_path):
             logger.info(f"Deleted short audio file: {file_path}")
             return "TOO_SHORT"  # Special return value to indicate too short audio
         
-        # Process audio of acceptable length
-        with sr.AudioFile(file_path) as source:
-            logger.info(f"Processing file: {file_path}")
-            audio_data = recognizer.record(source)
+        logger.info(f"Processing file: {file_path}")
+        
+        # Long recordings that are mostly silence don't carry enough of a query either
+        speech_timestamps = await asyncio.to_thread(detect_speech, samples)
+        speech_seconds = sum(ts["end"] - ts["start"] for ts in speech_timestamps) / WHISPER_SAMPLE_RATE
+        if speech_seconds < MIN_SPEECH_SECONDS:
+            logger.warning(f"Audio file {file_path} has too little speech: {speech_seconds:.2f} seconds (minimum {MIN_SPEECH_SECONDS}s required)")
+            os.remove(file_path)
+            logger.info(f"Deleted short audio file: {file_path}")
+            return "TOO_SHORT"
+        
+        async with recognition_semaphore:
+            text = await asyncio.to_thread(transcribe, samples, speech_timestamps)
+        
+        if not text:
+            logger.error(f"Could not understand the audio: {file_path}")
+            # Still delete the file even if transcription failed
+            os.remove(file_path)
+            logger.info(f"Deleted unrecognizable audio file: {file_path}")
+            return None
         
-        text = recognizer.recognize_google(audio_data)
         print(f"\n🔊 Transcribed Text from {os.path.basename(file_path)}:\n{text}\n")
         logger.info(f"Transcription successful: {text}")
 
@@ -149,21 +267,14 @@ async def process_audio(file_path):
         logger.info(f"Deleted processed file: {file_path}")
         return text
 
-    except sr.UnknownValueError:
-        logger.error(f"Could not understand the audio: {file_path}")
-        # Still delete the file even if transcription failed
-        os.remove(file_path)
-        logger.info(f"Deleted unrecognizable audio file: {file_path}")
-    except sr.RequestError:
-        logger.error("Error connecting to speech recognition service.")
     except Exception as e:
         logger.error(f"Error processing {file_path}: {e}")
         # Try to delete the file even if an error occurred
         try:
             os.remove(file_path)
             logger.info(f"Deleted file after error: {file_path}")
-        except:
-            pass
+        except OSError as remove_error:
+            logger.debug(f"Could not delete {file_path}: {remove_error}")
     return None
 
 async def process_existing_files():
@@ -179,21 +290,20 @@ async def process_existing_files():
     short_files = []
     
     try:
-        # Get list of all audio files in the directory
-        audio_files = []
-        for filename in os.listdir(DOWNLOAD_DIR):
-            file_path = os.path.join(DOWNLOAD_DIR, filename)
-            if os.path.isfile(file_path) and file_path.lower().endswith(('.wav', '.mp3', '.flac', '.ogg')):
-                audio_files.append(file_path)
+        # Get list of all audio files in the directory; scandir entries cache the file type
+        with os.scandir(DOWNLOAD_DIR) as entries:
+            audio_files = [
+                entry.path for entry in entries
+                if entry.name.lower().endswith(_AUDIO_EXT) and entry.is_file()
+            ]
         
         if audio_files:
             logger.info(f"Found {len(audio_files)} audio files to process")
             
-            # Process each file
-            for file_path in audio_files:
-                logger.info(f"Processing file: {file_path}")
-                text = await process_audio(file_path)
-                
+            # Process all files concurrently; results come back in input order
+            results = await asyncio.gather(*(process_audio(file_path) for file_path in audio_files))
+            
+            for file_path, text in zip(audio_files, results):
                 if text == "TOO_SHORT":
                     # Audio was too short, add to short files list
                     short_files.append(os.path.basename(file_path))
@@ -208,137 +318,441 @@ async def process_existing_files():
 
 def extract_name_from_sender(from_string):
     """Extract name from the sender email string."""
-    name_match = re.search(r'^(.*?)\s<', from_string)
+    name_match = _NAME_ANGLE.search(from_string)
     if name_match:
         return name_match.group(1)
-    name_match = re.search(r'"(.*?)"', from_string)
+    name_match = _NAME_QUOTE.search(from_string)
     if name_match:
         return name_match.group(1)
     return "Customer"
 
 def extract_email_from_sender(from_string):
     """Extract email address from the sender string."""
-    email_match = re.search(r'<(.*?)>', from_string)
+    email_match = _EMAIL_ANGLE.search(from_string)
     if email_match:
         return email_match.group(1)
     return from_string
 
+# Tokens of an IMAP parenthesized list: parens, quoted strings and atoms
+_IMAP_TOKEN = re.compile(rb'\(|\)|"((?:[^"\\]|\\.)*)"|([^\s()"]+)')
+_IMAP_LITERAL = re.compile(rb'\{\d+\}$')
+_IMAP_ESCAPE = re.compile(rb'\\(.)')
+_FETCH_SECTION = re.compile(rb'BODY\[([^\]]*)\]')
+
+def join_imap_response(data):
+    """Flatten an imaplib FETCH response, inlining literals as quoted strings."""
+    chunks = []
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            literal = literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+            chunks.append(_IMAP_LITERAL.sub(b"", head) + b'"' + literal + b'"')
+        elif item:
+            chunks.append(item)
+    return b"".join(chunks)
+
+def parse_imap_list(raw):
+    """Parse an IMAP parenthesized list into nested lists of strings (NIL becomes None)."""
+    stack = [[]]
+    for match in _IMAP_TOKEN.finditer(raw):
+        token = match.group(0)
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            if len(stack) > 1:
+                completed = stack.pop()
+                stack[-1].append(completed)
+        elif match.group(1) is not None:
+            stack[-1].append(_IMAP_ESCAPE.sub(rb'\1', match.group(1)).decode(errors="ignore"))
+        else:
+            atom = match.group(2).decode(errors="ignore")
+            stack[-1].append(None if atom.upper() == "NIL" else atom)
+    # Close any lists left open by a truncated response
+    while len(stack) > 1:
+        completed = stack.pop()
+        stack[-1].append(completed)
+    return stack[0]
+
+def _iter_leaf_parts(structure, section="", header_section=None):
+    """
+    Yield (section, header_section, structure) for every non-multipart part of a BODYSTRUCTURE.
+    
+    Forwarded message/rfc822 parts are descended into, as a full walk of the message would.
+    header_section names the section holding the part's MIME headers.
+    """
+    if structure and isinstance(structure[0], list):
+        # Child parts come first, followed by the multipart subtype and extension data
+        children = itertools.takewhile(lambda child: isinstance(child, list), structure)
+        for i, child in enumerate(children, start=1):
+            yield from _iter_leaf_parts(child, f"{section}.{i}" if section else str(i))
+    elif (len(structure) > 8 and isinstance(structure[8], list) and structure[8]
+            and str(structure[0]).lower() == "message" and str(structure[1]).lower() == "rfc822"):
+        nested = structure[8]
+        if isinstance(nested[0], list):
+            yield from _iter_leaf_parts(nested, section)
+        else:
+            # A single-part forwarded body is section N.1; its headers are the message's N.HEADER
+            yield from _iter_leaf_parts(nested, f"{section}.1", f"{section}.HEADER")
+    else:
+        yield section, header_section or f"{section}.MIME", structure
+
+def _params_dict(params):
+    """Convert a BODYSTRUCTURE parameter list into a lowercase-keyed dict."""
+    if not isinstance(params, list):
+        return {}
+    return {str(key).lower(): value for key, value in zip(params[::2], params[1::2])}
+
+def _part_disposition(part):
+    """Return (disposition, filename) for a single BODYSTRUCTURE part."""
+    main_type = str(part[0]).lower()
+    sub_type = str(part[1]).lower()
+    # The disposition follows the type-specific fields (RFC 3501, section 7.4.2)
+    if main_type == "text":
+        index = 9
+    elif main_type == "message" and sub_type == "rfc822":
+        index = 11
+    else:
+        index = 8
+
+    disposition, disposition_params = None, {}
+    if len(part) > index and isinstance(part[index], list) and part[index]:
+        disposition = str(part[index][0]).lower()
+        disposition_params = _params_dict(part[index][1] if len(part[index]) > 1 else None)
+
+    filename = disposition_params.get("filename") or disposition_params.get("filename*")
+    if filename is None:
+        filename = _params_dict(part[2]).get("name")
+    if filename:
+        decoded, encoding = decode_header(filename)[0]
+        if isinstance(decoded, bytes):
+            decoded = decoded.decode(encoding or "utf-8", errors="ignore")
+        filename = decoded
+    return disposition, filename
+
+def select_email_sections(structure):
+    """
+    Pick the parts of a multipart email worth downloading.
+    
+    Args:
+        structure (list): Parsed BODYSTRUCTURE of a multipart message
+        
+    Returns:
+        list: (section, header_section) of text/plain bodies and supported media attachments
+    """
+    sections = []
+    for section, header_section, part in _iter_leaf_parts(structure):
+        disposition, filename = _part_disposition(part)
+        if disposition == "attachment":
+            # Unnamed attachments are fetched so they get the same checks as before
+            if not filename or os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS:
+                sections.append((section, header_section))
+        elif str(part[0]).lower() == "text" and str(part[1]).lower() == "plain":
+            sections.append((section, header_section))
+    return sections
+
+def get_text_content(part):
+    """Return the decoded text of a message part."""
+    if part.get_content_maintype() == "text":
+        try:
+            return part.get_content()
+        except LookupError:
+            # Unknown charsets such as unknown-8bit; decode leniently like other payloads
+            pass
+    payload = part.get_payload(decode=True)
+    return payload.decode(errors="ignore") if payload else "No Content"
+
+def fetch_email(mail, uid):
+    """
+    Fetch an email, downloading only its text bodies and supported media attachments.
+    
+    Args:
+        mail (imaplib.IMAP4): Logged-in connection with a mailbox selected
+        uid (int): UID of the message to fetch
+        
+    Returns:
+        tuple: (message, body_part, attachments) where body_part is the text/plain
+            part (the message itself when single-part) or None. None on failure.
+    """
+    res, data = mail.uid('fetch', str(uid), "(BODYSTRUCTURE)")
+    if res != "OK" or not data or data[0] is None:
+        return None
+
+    fetch_items = parse_imap_list(join_imap_response(data))
+    fetch_items = next((item for item in fetch_items if isinstance(item, list)), [])
+    structure = dict(zip((str(key).upper() for key in fetch_items[::2]), fetch_items[1::2])).get("BODYSTRUCTURE")
+
+    if not structure or not isinstance(structure[0], list):
+        # Single-part message: the body is the whole message
+        res, data = mail.uid('fetch', str(uid), "(BODY.PEEK[])")
+        if res != "OK":
+            return None
+        msg = email_parser.parsebytes(data[0][1])
+        return msg, msg, []
+
+    sections = select_email_sections(structure)
+    items = ["BODY.PEEK[HEADER]"]
+    for section, header_section in sections:
+        items.extend((f"BODY.PEEK[{header_section}]", f"BODY.PEEK[{section}]"))
+    res, data = mail.uid('fetch', str(uid), f"({' '.join(items)})")
+    if res != "OK":
+        return None
+
+    fetched = {}
+    for item in data:
+        if isinstance(item, tuple):
+            name = _FETCH_SECTION.search(item[0])
+            if name:
+                fetched[name.group(1).decode()] = item[1]
+
+    msg = email_parser.parsebytes(fetched.get("HEADER", b""), headersonly=True)
+    # Rebuild each part from its MIME header and body so it can be decoded as usual
+    body_part = None
+    attachments = []
+    for section, header_section in sections:
+        if header_section not in fetched or section not in fetched:
+            continue
+        part = email_parser.parsebytes(fetched[header_section] + fetched[section])
+        if part.is_attachment():
+            attachments.append(part)
+        elif part.get_content_type() == "text/plain":
+            # As with a full walk of the message, the last plain-text body wins
+            body_part = part
+    return msg, body_part, attachments
+
+def _has_buffered_data(mail):
+    """Return True if a response line can be read without waiting on the socket."""
+    # imaplib reads through a buffered file, so lines can already sit in its buffer (or in the
+    # TLS layer) where select() cannot see them; peek without blocking to find out
+    previous_timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(previous_timeout)
+
+def idle_wait(mail, stop_event, timeout=IDLE_TIMEOUT):
+    """
+    Block in IMAP IDLE until the server announces new mail, the timeout expires or stop_event is set.
+    
+    Args:
+        mail (imaplib.IMAP4): Logged-in connection with a mailbox selected
+        stop_event (threading.Event): Set by the caller to end the IDLE early
+        timeout (float): Seconds to wait before ending the IDLE command
+        
+    Returns:
+        bool: True if the server reported new messages (EXISTS)
+    """
+    # EXISTS reported during earlier commands is not repeated once IDLE starts
+    if mail.untagged_responses.pop("EXISTS", None):
+        return True
+
+    tag = b"IDLE%d" % next(_idle_tags)
+    mail.send(tag + b" IDLE\r\n")
+    response = mail.readline()
+    if not response.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {response!r}")
+
+    has_new_mail = False
+    deadline = time.monotonic() + timeout
+    remaining = timeout
+    while remaining > 0 and not stop_event.is_set():
+        # Wait on the socket directly; a socket timeout would poison imaplib's reader
+        if not _has_buffered_data(mail):
+            readable, _, _ = select.select([mail.sock], [], [], min(remaining, IDLE_POLL_INTERVAL))
+            if not readable:
+                remaining = deadline - time.monotonic()
+                continue
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE")
+        if line.rstrip().upper().endswith(b"EXISTS"):
+            has_new_mail = True
+            break
+        remaining = deadline - time.monotonic()
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed while ending IDLE")
+        if line.startswith(tag + b" "):
+            break
+    return has_new_mail
+
+def fetch_new_uids(mail):
+    """Return the UIDs of messages that arrived after last_processed_uid, in order."""
+    status, data = mail.uid('search', None, f"UID {last_processed_uid + 1}:*")
+    if status != "OK":
+        logger.warning("Failed to search for new emails.")
+        return []
+    # "n:*" always matches the newest message, even if its UID is below n
+    return [uid for uid in (int(u) for u in data[0].split()) if uid > last_processed_uid]
+
+async def flush_pending_rows(pending_rows):
+    """Write accumulated partial customer rows to the CRM and clear the buffer."""
+    if not pending_rows:
+        return
+    # The MySQL driver is blocking, so run the write in a worker thread
+    result = await asyncio.to_thread(insert_partial_customer_query_batch, list(pending_rows))
+    logger.info(f"CRM batch insert result for {len(pending_rows)} rows: {result}")
+    pending_rows.clear()
+
+async def connect_imap():
+    """Connect, log in and select the inbox, retrying with exponential backoff."""
+    delay = IMAP_RETRY_DELAY
+    while True:
+        try:
+            logger.info(f"Connecting to IMAP server {IMAP_SERVER} with user {EMAIL}...")
+            mail = await asyncio.to_thread(imaplib.IMAP4_SSL, IMAP_SERVER, IMAP_PORT)
+            await asyncio.to_thread(mail.login, EMAIL, PASSWORD)
+            logger.info("Successfully logged in to IMAP server.")
+            
+            await asyncio.to_thread(mail.select, "inbox")
+            return mail
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.error(f"IMAP connection error: {e}. Retrying in {delay}s...")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, IMAP_MAX_RETRY_DELAY)
+
+async def disconnect_imap(mail):
+    """Log out of an IMAP connection, ignoring errors from a connection that is already gone."""
+    try:
+        await asyncio.to_thread(mail.logout)
+        logger.info("Logged out from IMAP server.")
+    except (imaplib.IMAP4.error, OSError):
+        pass
+
+# Complaints submitted within a short window are answered by one LLM call
+complaint_batcher = BatchingProcessor()
+
+async def reply_to_complaint(text, sender_name, recipient_email):
+    """Generate a response for one complaint and email it to the sender."""
+    response = await complaint_batcher.submit(text, sender_name, recipient_email)
+    
+    # Extract subject and body from response
+    if isinstance(response, dict):
+        subject = response.get("subject", "Customer Support")
+        body = response.get("body", "No response generated")
+    else:
+        # Handle case where response might be a string or other object
+        subject = "Customer Support"
+        body = str(response)
+    
+    # Send the email; process_email_sending cleans the body
+    logger.info(f"Sending email response to: {recipient_email}")
+    email_result = await process_email_sending_async(subject, body, recipient_email)
+    logger.info(f"Email sent result: {email_result}")
+
+async def reply_to_complaints(complaints):
+    """Answer (text, sender_name, recipient_email) complaints concurrently."""
+    # Log in to SMTP while the replies are being generated
+    warmup = asyncio.create_task(asyncio.to_thread(prewarm_smtp_pool, len(complaints)))
+    results = await asyncio.gather(
+        *(reply_to_complaint(*complaint) for complaint in complaints),
+        return_exceptions=True
+    )
+    await warmup
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error processing complaint: {result}")
+
 async def monitor_new_emails():
-    global last_processed_id
+    global last_processed_uid
     
     # Initialize CSV file
     initialize_csv()
     
     logger.info("🚀 Email monitoring started...")
     
+    # One logged-in connection is kept across cycles and only replaced when it breaks
+    mail = None
+    
     while True:
+        idled = False
         try:
-            logger.info(f"Connecting to IMAP server {IMAP_SERVER} with user {EMAIL}...")
-            mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-            mail.login(EMAIL, PASSWORD)
-            logger.info("Successfully logged in to IMAP server.")
+            if mail is None:
+                mail = await connect_imap()
+            elif "IDLE" not in mail.capabilities:
+                # Keep the polled connection alive and let the server report new messages
+                await asyncio.to_thread(mail.noop)
             
-            mail.select("inbox")
-            status, count_data = mail.status('INBOX', '(MESSAGES)')
-            if status != "OK":
-                logger.warning("Failed to get inbox status.")
-                continue
-                
-            messages_count = int(count_data[0].decode().split()[2].strip(').,]'))
-            logger.info(f"Total emails in inbox: {messages_count}")
-            
-            # If this is the first run, just record the latest email ID
-            if last_processed_id == 0 and messages_count > 0:
-                last_processed_id = messages_count
-                logger.info(f"First run: Setting last processed ID to {last_processed_id}")
-                mail.logout()
-                await asyncio.sleep(5)
-                continue
+            # If this is the first run, just record the latest email UID
+            if last_processed_uid is None:
+                status, uid_data = await asyncio.to_thread(mail.status, 'INBOX', '(UIDNEXT)')
+                if status != "OK":
+                    raise imaplib.IMAP4.error("Failed to get inbox status.")
+                uid_next = int(_UIDNEXT.search(uid_data[0]).group(1))
+                last_processed_uid = uid_next - 1
+                logger.info(f"First run: Setting last processed UID to {last_processed_uid}")
+                new_uids = []
+            else:
+                new_uids = await asyncio.to_thread(fetch_new_uids, mail)
             
             # Check if there are new emails
-            if messages_count > last_processed_id:
-                new_emails_count = messages_count - last_processed_id
-                logger.info(f"Found {new_emails_count} new email(s)!")
+            if new_uids:
+                logger.info(f"Found {len(new_uids)} new email(s)!")
                 
                 has_new_media = False
                 downloaded_files_info = []
+                pending_rows = []
+                complaints = []
                 
                 # Fetch only the new emails
-                for i in range(last_processed_id + 1, messages_count + 1):
-                    logger.info(f"Fetching new email ID: {i}")
-                    res, msg_data = mail.fetch(str(i), "(RFC822)")
-                    if res != "OK":
-                        logger.error(f"Error fetching email ID {i}")
+                for uid in new_uids:
+                    logger.info(f"Fetching new email UID: {uid}")
+                    fetched = await asyncio.to_thread(fetch_email, mail, uid)
+                    if fetched is None:
+                        logger.error(f"Error fetching email UID {uid}")
                         continue
                     
-                    raw_email = msg_data[0][1]
-                    msg = email.message_from_bytes(raw_email)
+                    msg, body_part, attachments = fetched
                     
-                    # Extract subject
-                    subject, encoding = decode_header(msg.get("Subject", "No Subject"))[0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(encoding if encoding else "utf-8")
-                    
-                    # Extract sender email
-                    from_ = msg.get("From", "Unknown")
+                    # Extract subject and sender; the default policy decodes encoded headers
+                    subject = str(msg.get("Subject", "No Subject"))
+                    from_ = str(msg.get("From", "Unknown"))
                     
                     # Extract email body and check for attachments
-                    body = "No Content"
+                    body = get_text_content(body_part) if body_part is not None else "No Content"
                     email_downloaded_files = []
                     
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            content_type = part.get_content_type()
-                            content_disposition = str(part.get("Content-Disposition"))
-                            
-                            # Get the text content
-                            if "attachment" not in content_disposition and content_type == "text/plain":
-                                body = part.get_payload(decode=True).decode(errors="ignore")
-                            
-                            # Download audio/video attachments
-                            if "attachment" in content_disposition:
-                                try:
-                                    filename = part.get_filename()
-                                    if filename:
-                                        # Decode filename if needed
-                                        if isinstance(filename, bytes):
-                                            filename = filename.decode()
-                                        elif decode_header(filename)[0][1] is not None:
-                                            filename = decode_header(filename)[0][0]
-                                            if isinstance(filename, bytes):
-                                                filename = filename.decode(decode_header(filename)[0][1])
-                                        
-                                        # Check if the file is an audio or video file
-                                        file_ext = os.path.splitext(filename)[1].lower()
-                                        if file_ext in SUPPORTED_EXTENSIONS:
-                                            # Found media file, clear previous files if this is the first one
-                                            if not has_new_media:
-                                                await clear_directory()
-                                                has_new_media = True
-                                            
-                                            # Sanitize filename to avoid issues
-                                            filename = re.sub(r'[\\/*?:"<>|]', "_", filename)
-                                            
-                                            filepath = os.path.join(DOWNLOAD_DIR, filename)
-                                            with open(filepath, 'wb') as f:
-                                                f.write(part.get_payload(decode=True))
-                                            
-                                            abs_path = os.path.abspath(filepath)
-                                            email_downloaded_files.append((filename, abs_path))
-                                            
-                                            # Add to our tracking list
-                                            downloaded_files_info.append({
-                                                "sender": from_,
-                                                "subject": subject,
-                                                "filename": filename,
-                                                "file_path": abs_path
-                                            })
-                                            
-                                            logger.info(f"Downloaded: {abs_path}")
-                                except Exception as e:
-                                    logger.error(f"Error downloading attachment: {e}")
-                    else:
-                        body = msg.get_payload(decode=True).decode(errors="ignore")
+                    # Download audio/video attachments
+                    for part in attachments:
+                        try:
+                            filename = part.get_filename()
+                            if filename:
+                                # Check if the file is an audio or video file
+                                file_ext = os.path.splitext(filename)[1].lower()
+                                if file_ext in SUPPORTED_EXTENSIONS:
+                                    # Found media file, clear previous files if this is the first one
+                                    if not has_new_media:
+                                        await clear_directory()
+                                        has_new_media = True
+                                    
+                                    # Sanitize filename to avoid issues
+                                    filename = _FN_SANITIZE.sub("_", filename)
+                                    
+                                    filepath = os.path.join(DOWNLOAD_DIR, filename)
+                                    # Decode the attachment once and drop it as soon as it is on disk
+                                    payload = part.get_payload(decode=True)
+                                    await asyncio.to_thread(write_file, filepath, payload)
+                                    del payload
+                                    
+                                    abs_path = os.path.abspath(filepath)
+                                    email_downloaded_files.append((filename, abs_path))
+                                    
+                                    # Add to our tracking list
+                                    downloaded_files_info.append({
+                                        "sender": from_,
+                                        "subject": subject,
+                                        "filename": filename,
+                                        "file_path": abs_path
+                                    })
+                                    
+                                    logger.info(f"Downloaded: {abs_path}")
+                        except Exception as e:
+                            logger.error(f"Error downloading attachment: {e}")
                     
                     # Return the new email details
                     logger.info(f"📩 New email received: \nFrom: {from_} \nSubject: {subject}\nBody: {body[:200]}...\n")
@@ -364,14 +778,13 @@ async def monitor_new_emails():
                                 logger.info(f"Text is too short ({word_count} words). Sending request for more details.")
                                 try:
                                     # Record partial customer data
-                                    insert_partial_customer_query(from_)
+                                    pending_rows.append((from_,))
                                     
                                     # Send response asking for more details
-                                    clean_body = clean_email_body(SHORT_TEXT_RESPONSE["body"])
                                     logger.info(f"Sending short text response to: {recipient_email}")
-                                    email_result = process_email_sending(
+                                    email_result = await process_email_sending_async(
                                         SHORT_TEXT_RESPONSE["subject"], 
-                                        clean_body, 
+                                        SHORT_TEXT_RESPONSE["body"], 
                                         recipient_email
                                     )
                                     logger.info(f"Short text response email result: {email_result}")
@@ -380,29 +793,11 @@ async def monitor_new_emails():
                             else:
                                 # Process adequate length text
                                 logger.info(f"Processing email body text directly. Word count: {word_count}")
-                                try:
-                                    # Record partial customer data
-                                    insert_partial_customer_query(from_)
-                                    
-                                    # Process the text content
-                                    response = process_customer_complaint(body, name)
-                                    
-                                    # Extract subject and body from response
-                                    if isinstance(response, dict):
-                                        response_subject = response.get("subject", "Customer Support")
-                                        response_body = response.get("body", "No response generated")
-                                    else:
-                                        # Handle case where response might be a string or other object
-                                        response_subject = "Customer Support"
-                                        response_body = str(response)
-                                    
-                                    # Clean up and send email response
-                                    clean_body = clean_email_body(response_body)
-                                    logger.info(f"Sending email response to: {recipient_email}")
-                                    email_result = process_email_sending(response_subject, clean_body, recipient_email)
-                                    logger.info(f"Email sent result: {email_result}")
-                                except Exception as e:
-                                    logger.error(f"Error processing text content: {e}")
+                                # Record partial customer data
+                                pending_rows.append((from_,))
+                                
+                                # Answered after the fetch loop so the cycle's complaints can share LLM batches
+                                complaints.append((body, name, recipient_email))
                     
                     # Log downloaded files for this email
                     if email_downloaded_files:
@@ -411,6 +806,15 @@ async def monitor_new_emails():
                             logger.info(f"📁 File saved at: {file_path}")
                     else:
                         logger.info("No audio/video attachments found in this email.")
+                    
+                    if len(pending_rows) >= CRM_BATCH_SIZE:
+                        await flush_pending_rows(pending_rows)
+                
+                # Record partial customer data for the whole poll cycle at once
+                await flush_pending_rows(pending_rows)
+                
+                if complaints:
+                    await reply_to_complaints(complaints)
                 
                 # Log all downloads to CSV
                 for file_info in downloaded_files_info:
@@ -422,43 +826,46 @@ async def monitor_new_emails():
                         file_info["filename"],
                         file_info["file_path"]
                     )
+                flush_csv()
 
                 # If we found and downloaded new media, process it immediately
                 if has_new_media:
                     logger.info("Processing newly downloaded audio files...")
                     transcriptions, short_files = await process_existing_files()
                     
+                    # Index downloads by filename; reversed so the first download of a name wins
+                    file_info_by_name = {info["filename"]: info for info in reversed(downloaded_files_info)}
+                    
                     # Handle short audio files
                     if short_files:
                         logger.info(f"Found {len(short_files)} audio files that were too short")
                         # Get unique senders for short audio files
                         short_audio_senders = set()
                         for filename in short_files:
-                            file_info = next((info for info in downloaded_files_info if info["filename"] == filename), None)
+                            file_info = file_info_by_name.get(filename)
                             if file_info:
                                 sender_email = extract_email_from_sender(file_info['sender'])
                                 short_audio_senders.add(sender_email)
                         
-                        # Send responses for short audio files
-                        for sender_email in short_audio_senders:
-                            logger.info(f"Sending short audio response to: {sender_email}")
-                            try:
-                                clean_body = clean_email_body(SHORT_AUDIO_RESPONSE["body"])
-                                email_result = process_email_sending(
-                                    SHORT_AUDIO_RESPONSE["subject"], 
-                                    clean_body, 
-                                    sender_email
-                                )
+                        # Send responses for short audio files in parallel
+                        logger.info(f"Sending short audio response to: {', '.join(short_audio_senders)}")
+                        try:
+                            email_results = await asyncio.to_thread(
+                                process_email_sending_bulk,
+                                [(SHORT_AUDIO_RESPONSE["subject"], SHORT_AUDIO_RESPONSE["body"], sender_email) for sender_email in short_audio_senders]
+                            )
+                            for email_result in email_results:
                                 logger.info(f"Short audio response email result: {email_result}")
-                            except Exception as e:
-                                logger.error(f"Error sending short audio response: {e}")
+                        except Exception as e:
+                            logger.error(f"Error sending short audio response: {e}")
                     
                     # Handle valid transcriptions
                     if transcriptions:
                         logger.info(f"Successfully transcribed {len(transcriptions)} audio files:")
+                        transcription_complaints = []
                         for filename, text in transcriptions:
                             # Find the corresponding file info to get the sender
-                            file_info = next((info for info in downloaded_files_info if info["filename"] == filename), None)
+                            file_info = file_info_by_name.get(filename)
                             if file_info:
                                 sender_name = extract_name_from_sender(file_info['sender'])
                                 recipient_email = extract_email_from_sender(file_info['sender'])
@@ -467,48 +874,57 @@ async def monitor_new_emails():
                                 recipient_email = "unknown@example.com"
                                 logger.warning(f"Could not find sender info for {filename}")
                             
-                            # Process the transcribed text
-                            response = process_customer_complaint(text, sender_name)
-                            
-                            # Extract subject and body
-                            if isinstance(response, dict):
-                                subject = response.get("subject", "Customer Support")
-                                body = response.get("body", "No response generated")
-                            else:
-                                # Handle case where response might be a string or other object
-                                subject = "Customer Support"
-                                body = str(response)
-                            
-                            # Clean up and send the email
-                            clean_body = clean_email_body(body)
-                            logger.info(f"Sending email response for audio transcription to: {recipient_email}")
-                            email_result = process_email_sending(subject, clean_body, recipient_email)
-                            logger.info(f"Email sent result: {email_result}")
+                            transcription_complaints.append((text, sender_name, recipient_email))
+                        
+                        # Process the transcribed texts together so they can share LLM batches
+                        await reply_to_complaints(transcription_complaints)
                     else:
                         logger.info("No successful transcriptions from the downloaded files.")
             
-                # Update the last processed ID
-                last_processed_id = messages_count
+                # Update the last processed UID
+                last_processed_uid = new_uids[-1]
             else:
                 logger.info("No new emails.")
             
-            mail.logout()
-            logger.info("Logged out from IMAP server.")
+            # Let the server push new mail to us instead of polling
+            if "IDLE" in mail.capabilities:
+                logger.info("Waiting for new emails (IDLE)...")
+                stop_idle = threading.Event()
+                try:
+                    has_new_mail = await asyncio.to_thread(idle_wait, mail, stop_idle)
+                except asyncio.CancelledError:
+                    # Let the worker end IDLE promptly so interpreter shutdown isn't held up
+                    stop_idle.set()
+                    raise
+                idled = True
+                if has_new_mail:
+                    logger.info("Server reported new mail.")
         
+        except (imaplib.IMAP4.abort, OSError) as e:
+            logger.error(f"IMAP connection lost: {e}. Reconnecting...")
+            if mail is not None:
+                await disconnect_imap(mail)
+            mail = None
         except imaplib.IMAP4.error as e:
-            logger.error(f"IMAP authentication error: {e}")
+            logger.error(f"IMAP error: {e}")
         except Exception as e:
             logger.error(f"General error monitoring emails: {e}")
         
-        logger.info("Waiting for new emails...")
-        await asyncio.sleep(5)
+        # Fall back to polling when the server does not support IDLE
+        if not idled:
+            logger.info("Waiting for new emails...")
+            await asyncio.sleep(5)
 
 async def main():
     # Start with a clean directory
+    await sweep_trash_directories()
     await clear_directory()
     
     # Start monitoring emails
     await monitor_new_emails()
 
 if __name__ == "__main__":
+    # Hand log records to a background writer so logging never blocks the event loop
+    logger.remove()
+    logger.add(sys.stderr, enqueue=True)
     asyncio.run(main())
\ No newline at end of file
@@ -1,36 +1,54 @@
 import os
-import json
+import atexit
+import orjson
+import asyncio
 import smtplib
 import re
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import threading
+import time
+import hashlib
+import queue
+from collections import Counter, OrderedDict
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import httpx
+from email import policy
+from email.message import EmailMessage
 from openai import OpenAI
-from crewai import Agent, Task, Crew
+from crewai import Agent, Task, Crew, LLM
+from pydantic import BaseModel
 from loguru import logger
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# One keep-alive HTTP/2 client, so TLS handshakes to the API are shared across requests
+client = OpenAI(
+    api_key=api_key,
+    http_client=httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    ),
+)
+# CrewAI's step-by-step console output is slow and prints customer data; opt in for debugging
+VERBOSE = os.getenv("CREWAI_VERBOSE", "0") == "1"
+# Wrapping text into {subject, body} needs no large model
+FORMATTER_MODEL = os.getenv("FORMATTER_MODEL_NAME", "gpt-4o-mini")
 
 
 
 complaint_analyzer = Agent(
     role="Complaint Analyzer",
-    goal="Accurately extract and categorize customer complaints",
+    goal="Accurately extract customer complaint details and answer them with a polite support email",
     backstory="""You are an expert in customer service with a background in natural language processing. 
     Your specialty is understanding customer needs and extracting key information from their messages.
     You need to extract only customer names (from username not from text), product issues, address, order IDs, and refund request status from complaint messages.
+    You then write polite, empathetic and professional support replies based on those details.
     """,
-    verbose=True,
-)
-
-response_generator = Agent(
-    role="Response Generator",
-    goal="Generate polite and professional customer support responses",
-    backstory="Customer service expert with strong empathy and problem-solving skills.",
-    verbose=True,
+    verbose=VERBOSE,
     allow_delegation=False,
 )
 
@@ -40,93 +58,544 @@ json_formatter = Agent(
     backstory="""You are a technical specialist who formats text responses into structured JSON objects.
     You take customer service responses and extract an appropriate subject line based on the content,
     then return a JSON object with 'subject' and 'body' fields.""",
-    verbose=True,
+    llm=LLM(model=FORMATTER_MODEL),
+    verbose=VERBOSE,
     allow_delegation=False,
 )
 
-def process_customer_complaint(user_message: str,username:str):
-    analysis_task = Task(
-        description=f"Analyze customer message and extract structured details: '{user_message}' and {username}",
-        agent=complaint_analyzer,
-        expected_output="A JSON object with complaint details",
-    )
-    
-    customer_service_crew = Crew(
+RESPONSE_JSON_FORMAT = """A clean JSON object with format: 
+    {
+        "subject": "Appropriate subject line based on the complaint",
+        "body": "The full text of the response"
+    }"""
+
+# Analysis, reply and JSON formatting happen in a single completion.
+# The instructions stay byte-identical and come first so the provider can reuse the cached
+# prompt prefix; only the customer message and username at the end change per call.
+COMPLAINT_TASK_TEMPLATE = (
+    "Analyze the customer message below and extract structured details using the username given with it. "
+    "Then write a polite, empathetic mail response based on the extracted details, with a proper subject "
+    "(subject should be always related to user query), and add in Best regards,supports@.com Customer Service "
+    "Team 24*7 supports or call us 1-800-123-4567. "
+    "Return ONLY a JSON object with 'subject' and 'body' fields and nothing else.\n\n"
+    "Customer message: '{user_message}'\n"
+    "Username: {username}"
+)
+
+class EmailResponse(BaseModel):
+    """Reply email the complaint and formatter tasks must return."""
+    subject: str
+    body: str
+
+# Tasks and crews are built once; each call only swaps in the task description
+complaint_task = Task(
+    description="Analyze the customer message and reply to it",
+    agent=complaint_analyzer,
+    expected_output=RESPONSE_JSON_FORMAT,
+    output_json=EmailResponse,
+)
+
+# Only used when the combined answer does not contain a usable JSON object
+format_task = Task(
+    description="Format the response into a JSON object with 'subject' and 'body' fields",
+    agent=json_formatter,
+    expected_output=RESPONSE_JSON_FORMAT,
+    output_json=EmailResponse,
+)
+
+_CREWS = {
+    "complaint": Crew(
         agents=[complaint_analyzer],
-        tasks=[analysis_task],
-        verbose=True,
-    )
-    result = customer_service_crew.kickoff()
-    if isinstance(result, dict) and "error" in result:
-        logger.error("Error extracting complaint details.")
-        return {"error": "Failed to process complaint."}
-    
-    # Generate Response
-    response_task = Task(
-        description=f"Generate a polite response based on extracted details: {result}",
-        agent=response_generator,
-        expected_output="A polite, empathetic mail response with proper subject(subject should be always related to user query) and add in Best regards,supports@.com Customer Service Team 24*7 supports or call us 1-800-123-4567",
-    )
-    response_crew = Crew(
-        agents=[response_generator],
-        tasks=[response_task],
-        verbose=True,
-    )
-    response = response_crew.kickoff()
-    
-    # Format as JSON
-    format_task = Task(
-        description=f"Format the following response into a JSON object with 'subject' and 'body' fields. Return ONLY the JSON object and nothing else: '{response}'",
-        agent=json_formatter,
-        expected_output="""A clean JSON object with format: 
-        {
-            "subject": "Appropriate subject line based on the complaint",
-            "body": "The full text of the response"
-        }""",
-    )
-    
-    format_crew = Crew(
+        tasks=[complaint_task],
+        verbose=VERBOSE,
+    ),
+    "format": Crew(
         agents=[json_formatter],
         tasks=[format_task],
-        verbose=True,
-    )
+        verbose=VERBOSE,
+    ),
+}
+# The shared tasks are mutated per call, so only one complaint may run through them at a time
+_crews_lock = threading.Lock()
+
+# Exact-match cache of generated responses, keyed on the complaint text and username
+RESPONSE_CACHE_SIZE = 10_000
+RESPONSE_CACHE_TTL = 3600
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _response_cache_key(user_message, username):
+    """Hash a complaint into a compact cache key."""
+    return hashlib.blake2b(f"{user_message}\0{username}".encode(), digest_size=16).hexdigest()
+
+def _get_cached_response(key):
+    """Return a cached response for the key, or None if missing or expired."""
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return dict(response)
+
+def _store_cached_response(key, response):
+    """Cache a response, evicting the least recently used entries when full."""
+    with _response_cache_lock:
+        _response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, dict(response))
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+# Semantic cache: responses to earlier complaints with near-identical meaning, matched by
+# cosine similarity of their embeddings. Entries are scoped to the sender address because the
+# generated replies repeat the customer's own details.
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_FILE = "semantic_cache.npz"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 5_000
+# Seconds to collect further changes before the cache is written to disk
+SEMANTIC_CACHE_SAVE_DELAY = 30
+# Order IDs, tracking numbers, postcodes: messages that differ only by these still embed as
+# near-identical, so replies to them are never served from the semantic cache
+_IDENTIFIER_RE = re.compile(r"\b(?=[\w-]*\d)[\w-]{3,}\b")
+_semantic_vectors = None
+_semantic_entries = []
+_semantic_cache_lock = threading.Lock()
+_semantic_save_timer = None
+
+def _semantic_cache_eligible(user_message, sender):
+    """Return True if a reply to this message may be shared through the semantic cache."""
+    return bool(sender) and _IDENTIFIER_RE.search(user_message) is None
+
+def _load_semantic_cache():
+    """Load the persisted semantic cache on first use."""
+    global _semantic_vectors, _semantic_entries
+    if _semantic_vectors is not None:
+        return
+    _semantic_vectors = np.empty((0, 0), dtype=np.float32)
+    if not os.path.exists(SEMANTIC_CACHE_FILE):
+        return
+    try:
+        with np.load(SEMANTIC_CACHE_FILE) as data:
+            _semantic_vectors = data["vectors"].astype(np.float32)
+            _semantic_entries = orjson.loads(data["entries"].item())
+        logger.info(f"Loaded {len(_semantic_entries)} semantic cache entries from {SEMANTIC_CACHE_FILE}")
+    except Exception as e:
+        # A truncated or corrupt file only costs the cached entries
+        logger.error(f"Failed to load semantic cache: {e}")
+        _semantic_vectors = np.empty((0, 0), dtype=np.float32)
+        _semantic_entries = []
+
+def _schedule_semantic_cache_save():
+    """Save the cache from a background timer shortly after a change. Call with the lock held."""
+    global _semantic_save_timer
+    if _semantic_save_timer is None:
+        _semantic_save_timer = threading.Timer(SEMANTIC_CACHE_SAVE_DELAY, _save_semantic_cache)
+        _semantic_save_timer.daemon = True
+        _semantic_save_timer.start()
+
+def _save_semantic_cache():
+    """Persist the semantic cache so hits survive restarts."""
+    global _semantic_save_timer
+    with _semantic_cache_lock:
+        _semantic_save_timer = None
+        if _semantic_vectors is None:
+            return
+        # Stores replace the array rather than modify it, so this reference stays consistent
+        vectors = _semantic_vectors
+        entries = orjson.dumps(_semantic_entries).decode()
     
-    formatted_response = format_crew.kickoff()
+    # Write to a temporary file and swap it in, so a crash never leaves a truncated cache
+    temp_file = SEMANTIC_CACHE_FILE + ".tmp"
+    try:
+        with open(temp_file, "wb") as f:
+            np.savez(f, vectors=vectors, entries=np.array(entries))
+        os.replace(temp_file, SEMANTIC_CACHE_FILE)
+    except OSError as e:
+        logger.error(f"Failed to save semantic cache: {e}")
+
+def _flush_semantic_cache():
+    """Write out changes still waiting on the save timer."""
+    timer = _semantic_save_timer
+    if timer is not None:
+        timer.cancel()
+        _save_semantic_cache()
+
+atexit.register(_flush_semantic_cache)
+
+def embed_messages(user_messages):
+    """Return unit-length embeddings for several messages in one request, or None on failure."""
+    try:
+        result = client.embeddings.create(model=EMBEDDING_MODEL, input=list(user_messages))
+    except Exception as e:
+        logger.error(f"Failed to embed message for semantic cache: {e}")
+        return None
+    embeddings = []
+    for item in result.data:
+        vector = np.asarray(item.embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        embeddings.append(vector / norm if norm else None)
+    return embeddings
+
+def embed_message(user_message):
+    """Return the unit-length embedding of a message, or None if the request fails."""
+    embeddings = embed_messages([user_message])
+    return embeddings[0] if embeddings else None
+
+def _lookup_semantic_cache(embedding, sender):
+    """Return the cached response most similar to the embedding, if above the threshold."""
+    with _semantic_cache_lock:
+        _load_semantic_cache()
+        if not _semantic_entries or _semantic_vectors.shape[1] != embedding.shape[0]:
+            return None
+        # Vectors are unit length, so the dot product is the cosine similarity
+        scores = _semantic_vectors @ embedding
+        for index in np.argsort(scores)[::-1]:
+            if scores[index] < SEMANTIC_CACHE_THRESHOLD:
+                return None
+            entry = _semantic_entries[index]
+            if entry.get("sender") == sender:
+                logger.info(f"Semantic cache hit (similarity {scores[index]:.3f}).")
+                return dict(entry["response"])
+        return None
+
+def _store_semantic_cache(embedding, sender, response):
+    """Add a response to the semantic cache and persist it."""
+    global _semantic_vectors, _semantic_entries
+    with _semantic_cache_lock:
+        _load_semantic_cache()
+        if _semantic_entries and _semantic_vectors.shape[1] != embedding.shape[0]:
+            # The embedding model changed; old vectors are not comparable
+            _semantic_vectors = np.empty((0, 0), dtype=np.float32)
+            _semantic_entries = []
+        if not _semantic_entries:
+            _semantic_vectors = embedding[np.newaxis, :]
+        else:
+            _semantic_vectors = np.vstack((_semantic_vectors, embedding))
+        _semantic_entries.append({"sender": sender, "response": dict(response)})
+        # Drop the oldest entries once the cache is full
+        if len(_semantic_entries) > SEMANTIC_CACHE_SIZE:
+            _semantic_vectors = _semantic_vectors[-SEMANTIC_CACHE_SIZE:]
+            _semantic_entries = _semantic_entries[-SEMANTIC_CACHE_SIZE:]
+        _schedule_semantic_cache_save()
+
+def process_customer_complaint(user_message: str,username:str,sender:str=None):
+    cache_key = _response_cache_key(user_message, username)
+    cached_response = _get_cached_response(cache_key)
+    if cached_response is not None:
+        logger.info("Returning cached response for repeated complaint.")
+        return cached_response
     
-    # Parse the JSON object if it's a string
-    if isinstance(formatted_response, str):
-        try:
-            if '{' in formatted_response and '}' in formatted_response:
-                # Extract JSON from string if it might be embedded in text
-                start_idx = formatted_response.find('{')
-                end_idx = formatted_response.rfind('}') + 1
-                json_str = formatted_response[start_idx:end_idx]
-                parsed_response = json.loads(json_str)
-                
-                # IMPORTANT: Extract the actual subject and body from the nested JSON
-                if 'body' in parsed_response and isinstance(parsed_response['body'], str):
+    # One embedding call can stand in for the whole LLM pipeline on paraphrased complaints
+    embedding = embed_message(user_message) if _semantic_cache_eligible(user_message, sender) else None
+    if embedding is not None:
+        cached_response = _lookup_semantic_cache(embedding, sender)
+        if cached_response is not None:
+            _store_cached_response(cache_key, cached_response)
+            return cached_response
+    
+    return _generate_response(user_message, username, sender, cache_key, embedding)
+
+def _generate_response(user_message, username, sender, cache_key, embedding):
+    """Run the crew pipeline for a complaint that missed both caches and cache the result."""
+    with _crews_lock:
+        response = _run_complaint_crews(user_message, username)
+    
+    if isinstance(response, dict) and "error" not in response:
+        _store_cached_response(cache_key, response)
+        if embedding is not None:
+            _store_semantic_cache(embedding, sender, response)
+    return response
+
+# Micro-batching: complaints arriving within a short window share one chat completion
+OPENAI_MODEL = os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini")
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_MS = 50
+
+BATCH_SYSTEM_PROMPT = (
+    "You are a customer service assistant. For each customer message, extract the structured details "
+    "(customer name from the username, not from the text, product issues, address, order IDs and refund "
+    "request status) and write a polite, empathetic mail response based on them, with a proper subject "
+    "(subject should be always related to user query), and add in Best regards,supports@.com Customer Service "
+    "Team 24*7 supports or call us 1-800-123-4567. "
+    "Process every complaint in the user message and return a JSON object of the form "
+    '{"responses": [{"id": <complaint id>, "subject": "...", "body": "..."}, ...]} '
+    "with exactly one entry per complaint, in order."
+)
+
+def _iter_streamed_objects(deltas):
+    """
+    Yield each object nested one level inside a streamed JSON object as soon as it closes.
+    
+    Args:
+        deltas: Iterable of text fragments making up one JSON object
+        
+    Yields:
+        dict: Each complete object of the top-level array, e.g. every entry of "responses"
+    """
+    depth = 0
+    in_string = escaped = False
+    current = []
+    for delta in deltas:
+        for char in delta:
+            if depth >= 2:
+                current.append(char)
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '{':
+                depth += 1
+                if depth == 2:
+                    current = [char]
+            elif char == '}':
+                depth -= 1
+                if depth == 1:
                     try:
-                        # The body might contain another JSON object
-                        if parsed_response['body'].strip().startswith('{') and parsed_response['body'].strip().endswith('}'):
-                            nested_json = json.loads(parsed_response['body'])
-                            if 'subject' in nested_json and 'body' in nested_json:
-                                return {
-                                    "subject": nested_json['subject'],
-                                    "body": nested_json['body']
-                                }
-                    except:
-                        pass
-                        
-                return parsed_response
-            else:
-                # Return default structure with original response
-                return {"subject": "Customer Support", "body": formatted_response}
-        except json.JSONDecodeError:
-            # If parsing fails, return the original response
-            return {"subject": "Customer Support", "body": formatted_response}
-    
-    # If formatted_response is already a dictionary or another object
-    return {"subject": "Customer Support", "body": str(formatted_response)}
+                        yield orjson.loads(''.join(current))
+                    except orjson.JSONDecodeError:
+                        logger.warning("Skipping malformed object in streamed batch response.")
+
+def _complete_batch(complaints, on_response):
+    """
+    Answer several complaints with a single streamed chat completion.
+    
+    Args:
+        complaints (list): (user_message, username, sender) tuples
+        on_response (callable): Called with (index, response) as soon as each reply is complete
+        
+    Returns:
+        list: One {"subject", "body"} dict per complaint, None where no valid reply arrived
+    """
+    payload = [
+        {"id": index, "username": username, "message": user_message}
+        for index, (user_message, username, _) in enumerate(complaints)
+    ]
+    results = [None] * len(complaints)
+    try:
+        stream = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            response_format={"type": "json_object"},
+            stream=True,
+            messages=[
+                {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                {"role": "user", "content": orjson.dumps(payload).decode()},
+            ],
+        )
+        deltas = (chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+        for item in _iter_streamed_objects(deltas):
+            index = item.get("id")
+            if not isinstance(index, int) or not 0 <= index < len(results) or results[index] is not None:
+                logger.warning(f"Batched completion returned an unknown complaint id: {index}")
+                continue
+            if "subject" not in item or "body" not in item:
+                logger.warning(f"Batched completion returned a malformed response for complaint {index}.")
+                continue
+            results[index] = {"subject": item["subject"], "body": item["body"]}
+            on_response(index, results[index])
+    except Exception as e:
+        logger.error(f"Batched complaint completion failed: {e}")
+    
+    if None in results:
+        logger.warning("Batched completion did not return one response per complaint.")
+    return results
+
+def process_customer_complaints_batch(complaints, on_result=None):
+    """
+    Process several complaints, sharing cache lookups and one LLM call between them.
+    
+    Args:
+        complaints (list): (user_message, username, sender) tuples
+        on_result (callable, optional): Called with (index, response) as soon as each response is known
+        
+    Returns:
+        list: Responses in the same order as the complaints
+    """
+    results = [None] * len(complaints)
+    
+    def deliver(index, response):
+        results[index] = response
+        if on_result is not None:
+            on_result(index, response)
+    
+    if len(complaints) == 1:
+        deliver(0, process_customer_complaint(*complaints[0]))
+        return results
+    
+    cache_keys = [_response_cache_key(user_message, username) for user_message, username, _ in complaints]
+    for index, cache_key in enumerate(cache_keys):
+        cached_response = _get_cached_response(cache_key)
+        if cached_response is not None:
+            deliver(index, cached_response)
+    
+    # Embed all remaining messages that may use the semantic cache in one request
+    pending = [
+        index for index, result in enumerate(results)
+        if result is None and _semantic_cache_eligible(complaints[index][0], complaints[index][2])
+    ]
+    embeddings = {}
+    if pending:
+        vectors = embed_messages(complaints[index][0] for index in pending)
+        if vectors is not None:
+            embeddings = {index: vector for index, vector in zip(pending, vectors) if vector is not None}
+        for index, embedding in embeddings.items():
+            cached_response = _lookup_semantic_cache(embedding, complaints[index][2])
+            if cached_response is not None:
+                _store_cached_response(cache_keys[index], cached_response)
+                deliver(index, cached_response)
+    
+    pending = [index for index, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+    
+    def store_streamed(position, response):
+        index = pending[position]
+        _store_cached_response(cache_keys[index], response)
+        if index in embeddings:
+            _store_semantic_cache(embeddings[index], complaints[index][2], response)
+        deliver(index, response)
+    
+    if len(pending) > 1:
+        _complete_batch([complaints[index] for index in pending], store_streamed)
+    
+    # Anything the batch could not answer goes through the regular pipeline; the cache
+    # lookups and embedding above already happened, so go straight to generation
+    for index in pending:
+        if results[index] is None:
+            deliver(index, _generate_response(*complaints[index], cache_keys[index], embeddings.get(index)))
+    return results
+
+class BatchingProcessor:
+    """Collect complaints submitted close together and answer them in one batch."""
+    
+    def __init__(self, max_batch=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+    
+    async def submit(self, user_message, username, sender=None):
+        """Queue a complaint and wait for its response."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_message, username, sender, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, batch):
+        complaints = [(user_message, username, sender) for user_message, username, sender, _ in batch]
+        if len(batch) > 1:
+            logger.info(f"Processing {len(batch)} complaints in one batch.")
+        loop = asyncio.get_running_loop()
+        
+        def resolve(index, result):
+            # Runs on the worker thread; hand each response to its waiter as soon as it is ready
+            loop.call_soon_threadsafe(self._resolve, batch[index][3], result)
+        
+        try:
+            results = await asyncio.to_thread(process_customer_complaints_batch, complaints, resolve)
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), result in zip(batch, results):
+            self._resolve(future, result)
+    
+    @staticmethod
+    def _resolve(future, result):
+        if not future.done():
+            future.set_result(result)
+
+def _run_complaint_crews(user_message, username):
+    complaint_crew = _CREWS["complaint"]
+    complaint_crew.tasks[0].description = COMPLAINT_TASK_TEMPLATE.format(user_message=user_message, username=username)
+    result = complaint_crew.kickoff()
+    if isinstance(result, dict) and "error" in result:
+        logger.error("Error processing complaint.")
+        return {"error": "Failed to process complaint."}
+    
+    parsed_response = parse_task_output(result)
+    if parsed_response is not None:
+        return parsed_response
+    
+    # Fall back to a dedicated formatting pass when the answer doesn't match the schema
+    response = str(result)
+    logger.warning("Complaint response was not valid JSON, running formatter.")
+    format_crew = _CREWS["format"]
+    format_crew.tasks[0].description = f"Format the following response into a JSON object with 'subject' and 'body' fields. Return ONLY the JSON object and nothing else: '{response}'"
+    formatted_result = format_crew.kickoff()
+    
+    parsed_response = parse_task_output(formatted_result)
+    if parsed_response is not None:
+        return parsed_response
+    
+    # Return default structure with original response
+    return {"subject": "Customer Support", "body": str(formatted_result)}
+
+def parse_task_output(result):
+    """
+    Read the {"subject", "body"} dict from a crew result.
+    
+    Args:
+        result: CrewOutput of a task declared with output_json=EmailResponse
+        
+    Returns:
+        dict: Parsed response, or None if the output did not match the schema
+    """
+    data = getattr(result, "json_dict", None)
+    if data is None:
+        return parse_response_json(str(result))
+    if "subject" not in data or "body" not in data:
+        return None
+    return {"subject": data["subject"], "body": data["body"]}
+
+def parse_response_json(response):
+    """
+    Parse a {"subject", "body"} dict from a model response given in JSON mode.
+    
+    Args:
+        response (str): Raw model output
+        
+    Returns:
+        dict: Parsed response, or None if it is not a JSON object with both fields
+    """
+    try:
+        parsed_response = orjson.loads(response)
+    except orjson.JSONDecodeError:
+        return None
+    
+    if not isinstance(parsed_response, dict) or "subject" not in parsed_response or "body" not in parsed_response:
+        return None
+    return {"subject": parsed_response["subject"], "body": parsed_response["body"]}
+
+# How often clean_email_body takes its JSON and escape fast paths, for tuning
+clean_body_stats = Counter()
+
+# Quotes and surrounding whitespace left over from JSON-encoded bodies
+_TRIM_QUOTES_RE = re.compile(r'^\s*"\s*|\s*"\s*$')
 
 def clean_email_body(body):
     """
@@ -145,35 +614,148 @@ def clean_email_body(body):
     if not isinstance(body, str):
         body = str(body)
     
+    # Strip once; quote trimming below works on the same stripped string
+    body = body.strip()
+    
     # Try to detect if this is a JSON string and extract just the body content
-    try:
-        if body.strip().startswith('{') and body.strip().endswith('}'):
-            parsed = json.loads(body)
-            if 'body' in parsed:
-                body = parsed['body']
-    except:
-        pass
-        
-    # Replace escaped newlines with actual newlines
-    body = body.replace('\\n', '\n')
+    from_json = False
+    if body[:1] == '{' and body[-1:] == '}':
+        try:
+            parsed = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            clean_body_stats["json_miss"] += 1
+            logger.debug(f"Body looked like JSON but did not parse ({clean_body_stats['json_miss']} so far).")
+        else:
+            if isinstance(parsed, dict) and isinstance(parsed.get('body'), str):
+                clean_body_stats["json_hit"] += 1
+                body = parsed['body'].strip()
+                from_json = True
     
-    # Replace Unicode escape sequences
-    try:
-        body = body.encode().decode('unicode_escape')
-    except:
-        pass
+    # Escaped newlines, double backslashes and unicode escapes are resolved in one pass,
+    # and only when there is a backslash to resolve; parsing already resolved them in a JSON body
+    if not from_json and '\\' in body:
+        try:
+            # Latin-1 maps each code point to one byte, and backslashreplace spells out the rest
+            # as \u escapes, so non-ASCII text survives the decode unchanged
+            body = body.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+        except UnicodeDecodeError:
+            clean_body_stats["escape_fallback"] += 1
+            logger.debug(f"Malformed escape sequence in body ({clean_body_stats['escape_fallback']} so far).")
+            body = body.replace('\\n', '\n').replace('\\\\', '\\')
     
     # Remove extra quotes at the beginning and end if they exist
     body = body.strip('"\'')
     
     # Clean up any JSON formatting artifacts
-    body = re.sub(r'^\s*"\s*|\s*"\s*$', '', body)
-    
-    # Replace double backslashes with single backslashes
-    body = body.replace('\\\\', '\\')
+    body = _TRIM_QUOTES_RE.sub('', body)
     
     return body
 
+# Pool of logged-in SMTP sessions reused across sends
+SMTP_POOL_SIZE = 5
+SMTP_MAX_ATTEMPTS = 3
+SMTP_RETRY_DELAY = 1
+# Transient SMTP replies worth retrying on a fresh connection
+SMTP_RETRY_CODES = frozenset({421, 450, 554})
+_smtp_pool = queue.Queue(maxsize=SMTP_POOL_SIZE)
+
+# SMTP settings are read once at import rather than on every send
+_SMTP_CFG = SimpleNamespace(
+    server=os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+    port=int(os.getenv("SMTP_PORT", 587)),
+    user=os.getenv("USERNAME_EMAIL"),
+    password=os.getenv("MAIL_PASSWORD"),
+)
+
+def _open_smtp_connection():
+    """Open a new SMTP session with STARTTLS and login done."""
+    server = smtplib.SMTP(_SMTP_CFG.server, _SMTP_CFG.port)
+    try:
+        server.starttls()
+        server.login(_SMTP_CFG.user, _SMTP_CFG.password)
+    except Exception:
+        _close_smtp_connection(server)
+        raise
+    return server
+
+def _close_smtp_connection(server):
+    """Close an SMTP session, ignoring errors from one that is already gone."""
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+def _checkout_smtp_connection():
+    """Take a live session from the pool, opening a new one if none is available."""
+    while True:
+        try:
+            server = _smtp_pool.get_nowait()
+        except queue.Empty:
+            return _open_smtp_connection()
+        # NOOP detects sessions the server closed while they sat in the pool
+        try:
+            if server.noop()[0] == 250:
+                return server
+        except (smtplib.SMTPException, OSError):
+            pass
+        _close_smtp_connection(server)
+
+def _release_smtp_connection(server):
+    """Return a healthy session to the pool, closing it if the pool is full."""
+    try:
+        _smtp_pool.put_nowait(server)
+    except queue.Full:
+        _close_smtp_connection(server)
+
+def _send_with_pool(message):
+    """Send a message over a pooled session, retrying transient failures with backoff."""
+    # Serialize once with CRLF line endings and pass the envelope explicitly,
+    # so retries don't re-render the message or re-parse its headers
+    data = message.as_bytes(policy=policy.SMTP)
+    from_addr, to_addrs = message["From"], [message["To"]]
+    for attempt in range(1, SMTP_MAX_ATTEMPTS + 1):
+        server = _checkout_smtp_connection()
+        try:
+            server.sendmail(from_addr, to_addrs, data)
+        except smtplib.SMTPServerDisconnected:
+            # Stale session; retry straight away on a new one
+            server.close()
+            if attempt == SMTP_MAX_ATTEMPTS:
+                raise
+        except smtplib.SMTPResponseException as e:
+            _close_smtp_connection(server)
+            if e.smtp_code not in SMTP_RETRY_CODES or attempt == SMTP_MAX_ATTEMPTS:
+                raise
+            delay = SMTP_RETRY_DELAY * 2 ** (attempt - 1)
+            logger.warning(f"SMTP error {e.smtp_code}, retrying in {delay}s...")
+            time.sleep(delay)
+        except Exception:
+            _close_smtp_connection(server)
+            raise
+        else:
+            _release_smtp_connection(server)
+            return
+
+def prewarm_smtp_pool(count=1):
+    """Log in up to count sessions ahead of time so the next sends skip the handshake."""
+    for _ in range(min(count, SMTP_POOL_SIZE - _smtp_pool.qsize())):
+        try:
+            server = _open_smtp_connection()
+        except Exception as e:
+            logger.warning(f"Failed to pre-open SMTP session: {e}")
+            return
+        _release_smtp_connection(server)
+
+def _build_msg(subject, body, sender, recipient):
+    """Build a single-part plain text message; replies carry no attachments."""
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = recipient
+    # The default policy rejects line breaks in headers, which model subjects sometimes contain
+    message["Subject"] = " ".join(subject.split())
+    message.set_content(body)
+    return message
+
 def process_email_sending(subject, body, recipient):
     """
     Send an email with the given subject and body to the recipient.
@@ -197,27 +779,11 @@ def process_email_sending(subject, body, recipient):
     clean_body = clean_email_body(body)
     
     try:
-        # Email configuration
-        smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-        smtp_port = int(os.getenv("SMTP_PORT", 587))
-        smtp_username = os.getenv("USERNAME_EMAIL")
-        smtp_password = os.getenv("MAIL_PASSWORD")
-        sender_email = recipient
+        # Send as the authenticated account; providers reject or rewrite other From addresses
+        message = _build_msg(subject, clean_body, _SMTP_CFG.user, recipient)
         
-        # Create message
-        message = MIMEMultipart()
-        message["From"] = sender_email
-        message["To"] = recipient
-        message["Subject"] = subject
-        
-        # Attach body with proper newlines preserved
-        message.attach(MIMEText(clean_body, "plain"))
-        
-        # Send email
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(message)
+        # Send email over a pooled, already authenticated session
+        _send_with_pool(message)
             
         logger.info(f"Email sent successfully to {recipient}")
         return {
@@ -236,4 +802,33 @@ def process_email_sending(subject, body, recipient):
             "subject": subject
         }
 
+# Parallel SMTP sessions providers accept before throttling
+SMTP_PROVIDER_CONCURRENCY = {
+    "smtp.gmail.com": 15,
+    "smtp.zoho.com": 5,
+}
+
+def process_email_sending_bulk(messages, concurrency=SMTP_POOL_SIZE):
+    """
+    Send many emails in parallel over the SMTP session pool.
+    
+    Args:
+        messages (list[tuple]): (subject, body, recipient) for each email
+        concurrency (int): Maximum number of sends in flight
+        
+    Returns:
+        list[dict]: Status of each send, in the same order as messages
+    """
+    if not messages:
+        return []
+    
+    concurrency = min(concurrency, SMTP_PROVIDER_CONCURRENCY.get(_SMTP_CFG.server, concurrency), len(messages))
+    
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        return list(executor.map(lambda args: process_email_sending(*args), messages))
+
+async def process_email_sending_async(subject, body, recipient):
+    """Send an email without blocking the event loop; see process_email_sending."""
+    return await asyncio.to_thread(process_email_sending, subject, body, recipient)
+
 